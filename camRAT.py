@@ -1,21 +1,54 @@
+import ctypes
 import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
 import time
-from threading import Lock
+import zlib
+from threading import BoundedSemaphore, Condition, Lock, Thread
 
 import cv2
 import mss
 import numpy as np
 import pygetwindow as gw
-from flask import Flask, Response, make_response, render_template_string, request
+from flask import Flask, Response, make_response, request
+
+try:
+    import turbojpeg
+    from turbojpeg import TJPF_BGR, TJPF_BGRX, TJSAMP_420, TurboJPEG
+except ImportError:     # PyTurboJPEG not installed -> cv2.imencode fallback
+    TurboJPEG = None
+
+try:
+    from xxhash import xxh3_64_intdigest
+except ImportError:     # zlib.crc32 for the unchanged-frame check
+    xxh3_64_intdigest = None
+
+dxcam = None
+if sys.platform == "win32":
+    try:
+        import dxcam
+    except ImportError:     # no DXGI capture -> mss (BitBlt) for every grab
+        dxcam = None
 
 app = Flask(__name__)
 
 # ---- Config ----
 FPS = 10
 JPEG_QUALITY = 70
+STREAM_MAX_WIDTH = 640   # downscale wider stream frames before encoding (0 = never)
+MAX_IDLE_SEC = 2.0       # unchanged frames aren't re-encoded; the last one is re-sent this often
 WINDOW_TITLE = "DMV-Viewer"   # substring that must appear in the window title
 BIND_IP = "0.0.0.0"      # LAN IP to bind (use "0.0.0.0" to listen on all)
 PORT = 8081
+BBOX_REFRESH_SEC = 1.0   # re-locate the window at most this often (bounds staleness after a move)
+SERVER_THREADS = 16      # waitress worker threads; each open stream holds one
+MAX_STREAM_CLIENTS = 12  # concurrent stream clients; keeps SERVER_THREADS free for pages/snapshots
+FFMPEG_BIN = "ffmpeg"    # used by /stream.m4s (H.264 fragmented MP4)
+USE_DXCAM = True         # Windows: capture via DXGI Desktop Duplication (dxcam) when installed
+PRODUCER_CPUS = None     # e.g. (0, 2, 4, 6): pin the grab/encode thread to these CPUs (P-cores); None = unpinned
 
 # ---- ROI settings ----
 # Choose cropping mode: "relative" (fractions 0..1) or "absolute" (pixels)
@@ -35,12 +68,40 @@ ROI_CLAMP = 0
 ROI_RUNTIME_MODE = None        # "absolute" or "relative"
 ROI_RUNTIME_ABS  = None        # (x,y,w,h)
 ROI_RUNTIME_REL  = None        # (l,t,r,b)
+ROI_VERSION      = 0           # bumped by /set_roi so cached ROI dicts get rebuilt
 
 lock = Lock()
 
 # Basic logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
+# libjpeg-turbo encoder (SIMD DCT/quant/Huffman); None -> use cv2.imencode
+_tj = None
+if TurboJPEG is not None:
+    try:
+        _tj = TurboJPEG()
+    except Exception as e:   # Python package present but libturbojpeg not found
+        logging.warning("TurboJPEG unavailable (%s); falling back to cv2.imencode", e)
+
+def _log_encoder_info():
+    """Log the JPEG encoder in use and warn when libjpeg-turbo can't use its fastest SIMD kernels."""
+    if _tj is None:
+        logging.info("JPEG encoder: cv2.imencode (OpenCV %s)", cv2.__version__)
+        return
+    logging.info("JPEG encoder: libjpeg-turbo via PyTurboJPEG %s", getattr(turbojpeg, "__version__", "?"))
+    # libjpeg-turbo picks its SIMD level at runtime; these env vars force it down
+    forced = [k for k in ("JSIMD_FORCENONE", "JSIMD_FORCEMMX", "JSIMD_FORCESSE", "JSIMD_FORCESSE2")
+              if os.environ.get(k) == "1"]
+    if forced:
+        logging.warning("libjpeg-turbo SIMD restricted by %s", ", ".join(forced))
+    machine = platform.machine().lower()
+    if machine in ("x86_64", "amd64") and not cv2.checkHardwareSupport(cv2.CPU_AVX2):
+        logging.warning("CPU lacks AVX2; libjpeg-turbo falls back to its SSE2 kernels")
+    elif machine in ("arm64", "aarch64") and not cv2.checkHardwareSupport(cv2.CPU_NEON):
+        logging.warning("NEON not reported by the CPU; libjpeg-turbo will run without SIMD")
+
+_log_encoder_info()
+
 
 # ---------------- Window / ROI helpers ----------------
 
@@ -55,6 +116,30 @@ def find_window_bbox():
     left, top, right, bottom = w.left, w.top, w.right, w.bottom
     return {"title": w.title, "top": top, "left": left, "width": right - left, "height": bottom - top}
 
+_bbox_cache = {"bbox": None, "expires": 0.0, "roi": None, "roi_version": None}
+_bbox_lock = Lock()   # producer + snapshot request threads share _bbox_cache
+
+def cached_window_roi():
+    """(bbox, ROI dict) for the per-frame path: bbox re-queried every BBOX_REFRESH_SEC, ROI only on change."""
+    with _bbox_lock:
+        cache = _bbox_cache
+        now = time.monotonic()
+        if cache["bbox"] is None or now >= cache["expires"]:
+            bbox = find_window_bbox()
+            if bbox != cache["bbox"]:   # window moved/resized: re-derive the ROI below
+                cache["bbox"] = bbox
+                cache["roi_version"] = None
+            cache["expires"] = now + BBOX_REFRESH_SEC
+        if cache["roi_version"] != ROI_VERSION:
+            cache["roi"] = _apply_roi_to_bbox(cache["bbox"])
+            cache["roi_version"] = ROI_VERSION
+        return cache["bbox"], cache["roi"]
+
+def invalidate_window_bbox():
+    """Force the next cached_window_roi() call to re-enumerate windows."""
+    with _bbox_lock:
+        _bbox_cache["expires"] = 0.0
+
 def _roi_from_absolute(bbox, abs_roi):
     """Absolute (x,y,w,h) inside the window bbox -> ROI dict for mss."""
     L, T, W, H = bbox["left"], bbox["top"], bbox["width"], bbox["height"]
@@ -92,86 +177,511 @@ def _apply_roi_to_bbox(bbox):
         roi["height"] = max(1, roi["height"] - 2 * ROI_CLAMP)
     return roi
 
+def _shot_to_array(shot):
+    """Zero-copy HxWx4 (BGRA) view over an mss screenshot buffer."""
+    return np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+
+_dxcam_lock = Lock()   # one duplication session, shared by the producer and snapshot threads
+_dxcam_state = {"camera": None, "failed": False, "region": None, "img": None}
+
+def _dxcam_grab(roi):
+    """Grab an mss-style ROI dict via dxcam as HxWx4 BGRA, or None if DXGI can't serve it."""
+    region = (roi["left"], roi["top"], roi["left"] + roi["width"], roi["top"] + roi["height"])
+    with _dxcam_lock:
+        cam = _dxcam_state["camera"]
+        if cam is None:
+            if _dxcam_state["failed"]:
+                return None
+            try:
+                cam = dxcam.create(output_color="BGRA")
+            except Exception as e:
+                logging.warning("dxcam unavailable (%s); using mss", e)
+                _dxcam_state["failed"] = True
+                return None
+            _dxcam_state["camera"] = cam
+        img = cam.grab(region=region)
+        if img is None:
+            # dxcam returns None when the desktop hasn't changed since the last grab
+            return _dxcam_state["img"] if _dxcam_state["region"] == region else None
+        img = np.ascontiguousarray(img)
+        _dxcam_state["region"], _dxcam_state["img"] = region, img
+        return img
+
+def _grab_region(sct, roi):
+    """Grab an mss-style ROI dict as HxWx4 BGRA (DXGI on Windows when available, else the sct grabber)."""
+    if dxcam is not None and USE_DXCAM:
+        try:
+            img = _dxcam_grab(roi)
+        except Exception as e:   # e.g. region not on the primary output
+            app.logger.debug("dxcam grab failed (%s); using mss", e)
+            img = None
+        if img is not None:
+            return img
+    return sct.grab(roi)
+
+class _MssGrabber:
+    """mss behind the _GdiGrabber interface: grab(roi) returns an HxWx4 BGRA array."""
+
+    def __init__(self):
+        self._sct = mss.mss()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._sct.close()
+
+    def grab(self, roi):
+        return _shot_to_array(self._sct.grab(roi))
+
+class _BITMAPINFO(ctypes.Structure):
+    _fields_ = [
+        ("biSize", ctypes.c_uint32), ("biWidth", ctypes.c_int32), ("biHeight", ctypes.c_int32),
+        ("biPlanes", ctypes.c_uint16), ("biBitCount", ctypes.c_uint16), ("biCompression", ctypes.c_uint32),
+        ("biSizeImage", ctypes.c_uint32), ("biXPelsPerMeter", ctypes.c_int32), ("biYPelsPerMeter", ctypes.c_int32),
+        ("biClrUsed", ctypes.c_uint32), ("biClrImportant", ctypes.c_uint32), ("bmiColors", ctypes.c_uint32 * 3),
+    ]
+
+class _GdiGrabber:
+    """BitBlt + GetDIBits grabber (Windows) that keeps its DCs, bitmap and numpy buffer across frames.
+
+    Same GDI calls as mss's Windows backend, but pixels land directly in a reused array.
+    ctypes releases the GIL around every WinDLL call, so the copy overlaps request threads.
+    """
+    SRCCOPY = 0x00CC0020
+    CAPTUREBLT = 0x40000000
+    DIB_RGB_COLORS = 0
+
+    def __init__(self):
+        self._user32 = user32 = ctypes.WinDLL("user32", use_last_error=True)
+        self._gdi32 = gdi32 = ctypes.WinDLL("gdi32", use_last_error=True)
+        HANDLE, INT = ctypes.c_void_p, ctypes.c_int
+        user32.GetWindowDC.argtypes = (HANDLE,)
+        user32.GetWindowDC.restype = HANDLE
+        user32.ReleaseDC.argtypes = (HANDLE, HANDLE)
+        gdi32.CreateCompatibleDC.argtypes = (HANDLE,)
+        gdi32.CreateCompatibleDC.restype = HANDLE
+        gdi32.CreateCompatibleBitmap.argtypes = (HANDLE, INT, INT)
+        gdi32.CreateCompatibleBitmap.restype = HANDLE
+        gdi32.SelectObject.argtypes = (HANDLE, HANDLE)
+        gdi32.SelectObject.restype = HANDLE
+        gdi32.DeleteObject.argtypes = (HANDLE,)
+        gdi32.DeleteDC.argtypes = (HANDLE,)
+        gdi32.BitBlt.argtypes = (HANDLE, INT, INT, INT, INT, HANDLE, INT, INT, ctypes.c_uint32)
+        gdi32.GetDIBits.argtypes = (HANDLE, HANDLE, ctypes.c_uint, ctypes.c_uint, ctypes.c_void_p,
+                                    ctypes.POINTER(_BITMAPINFO), ctypes.c_uint)
+        try:
+            # Physical pixel coordinates, like mss (pygetwindow bboxes depend on this)
+            ctypes.WinDLL("shcore").SetProcessDpiAwareness(2)
+        except (OSError, AttributeError):
+            pass
+
+        self._srcdc = user32.GetWindowDC(None)
+        self._memdc = gdi32.CreateCompatibleDC(self._srcdc)
+        self._bmp = None
+        self._old_bmp = None   # memdc's original bitmap, selected back before deleting ours
+        self._buf = None
+        self._bmi = _BITMAPINFO()
+        self._bmi.biSize = ctypes.sizeof(_BITMAPINFO) - ctypes.sizeof(ctypes.c_uint32 * 3)
+        self._bmi.biPlanes = 1
+        self._bmi.biBitCount = 32   # BGRX rows, BI_RGB
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _release_bitmap(self):
+        if self._bmp:
+            # A bitmap still selected into a DC can't be deleted
+            self._gdi32.SelectObject(self._memdc, self._old_bmp)
+            self._gdi32.DeleteObject(self._bmp)
+            self._bmp = None
+
+    def close(self):
+        self._release_bitmap()
+        if self._memdc:
+            self._gdi32.DeleteDC(self._memdc)
+            self._memdc = None
+        if self._srcdc:
+            self._user32.ReleaseDC(None, self._srcdc)
+            self._srcdc = None
+
+    def grab(self, roi):
+        """Grab an mss-style ROI dict as HxWx4 BGRA; the array is reused by the next grab."""
+        w, h = roi["width"], roi["height"]
+        if self._bmp is None or self._buf.shape[:2] != (h, w):
+            self._release_bitmap()
+            bmp = self._gdi32.CreateCompatibleBitmap(self._srcdc, w, h)
+            if not bmp:   # huge ROI / GDI handles exhausted: retry the rebuild next grab
+                raise ctypes.WinError(ctypes.get_last_error())
+            self._bmp = bmp
+            self._old_bmp = self._gdi32.SelectObject(self._memdc, bmp)
+            self._bmi.biWidth = w
+            self._bmi.biHeight = -h     # negative -> top-down rows
+            self._buf = np.empty((h, w, 4), dtype=np.uint8)
+        if not self._gdi32.BitBlt(self._memdc, 0, 0, w, h, self._srcdc, roi["left"], roi["top"],
+                                  self.SRCCOPY | self.CAPTUREBLT):
+            raise ctypes.WinError(ctypes.get_last_error())
+        if self._gdi32.GetDIBits(self._memdc, self._bmp, 0, h, self._buf.ctypes.data,
+                                 ctypes.byref(self._bmi), self.DIB_RGB_COLORS) != h:
+            raise ctypes.WinError(ctypes.get_last_error())
+        return self._buf
+
+def _open_grabber():
+    """Screen grabber for the producer thread: _GdiGrabber on Windows, mss elsewhere or on failure."""
+    if sys.platform == "win32":
+        try:
+            return _GdiGrabber()
+        except Exception as e:
+            logging.warning("GDI grabber unavailable (%s); using mss", e)
+    return _MssGrabber()
+
+def _to_bgr(img):
+    """Drop the alpha/padding channel for code paths that draw with cv2."""
+    if img.ndim == 3 and img.shape[2] == 4:
+        return cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return img
+
 def grab_frame(sct):
-    """Grab a cropped frame of the target window, or return an error frame and the exception."""
+    """Grab a cropped frame (BGRA) of the target window, or return a BGR error frame and the exception."""
     try:
-        bbox_win = find_window_bbox()
-        bbox_roi = _apply_roi_to_bbox(bbox_win)
-        shot = sct.grab(bbox_roi)
-        img = cv2.cvtColor(np.array(shot), cv2.COLOR_BGRA2BGR)
-        return img, None
+        _, bbox_roi = cached_window_roi()
+        return _grab_region(sct, bbox_roi), None
     except Exception as e:
+        invalidate_window_bbox()
         img = np.zeros((480, 640, 3), dtype=np.uint8)
         cv2.putText(img, str(e), (20, 240), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
         return img, e
 
 def grab_full_window(sct):
-    """Grab the full window image as BGR, plus its bbox dict."""
+    """Grab the full window image as BGRA, plus its bbox dict."""
     bbox_win = find_window_bbox()
-    shot = sct.grab({k: bbox_win[k] for k in ("top", "left", "width", "height")})
-    img = cv2.cvtColor(np.array(shot), cv2.COLOR_BGRA2BGR)
+    img = _grab_region(sct, {k: bbox_win[k] for k in ("top", "left", "width", "height")})
     return img, bbox_win
 
-def encode_jpeg(img):
-    ok, jpg = cv2.imencode(".jpg", img, [int(cv2.IMWRITE_JPEG_QUALITY), int(JPEG_QUALITY)])
+# cv2 fallback: explicit 4:2:0 chroma (matches the TurboJPEG path) + optimized Huffman tables
+_CV2_JPEG_EXTRA = [int(cv2.IMWRITE_JPEG_OPTIMIZE), 1]
+if hasattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR"):   # OpenCV >= 4.5.5
+    _CV2_JPEG_EXTRA += [int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR), int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR_420)]
+
+def encode_jpeg(img, pixel_format=None):
+    """Encode a BGR or BGRA/BGRX image; pixel_format defaults from the channel count."""
+    if _tj is not None:
+        if pixel_format is None:
+            pixel_format = TJPF_BGRX if img.shape[2] == 4 else TJPF_BGR
+        return _tj.encode(img, quality=int(JPEG_QUALITY), pixel_format=pixel_format, jpeg_subsample=TJSAMP_420)
+    # cv2's JPEG writer accepts 4-channel input and drops alpha row by row
+    ok, jpg = cv2.imencode(".jpg", img, [int(cv2.IMWRITE_JPEG_QUALITY), int(JPEG_QUALITY)] + _CV2_JPEG_EXTRA)
     if not ok:
         raise RuntimeError("JPEG encode failed")
     return jpg.tobytes()
 
-def mjpeg_generator():
+# ---------------- Shared frame producer ----------------
+# One background thread grabs + encodes; every /stream.mjpg client just waits
+# for the next frame id, so N viewers cost one grab and one encode per frame.
+# Clients yield the producer's bytes objects by reference (no per-client copy);
+# this relies on a single server process (waitress threads / Flask threaded),
+# since each extra worker process would run its own producer and screen grabs.
+
+_frame_cond = Condition()
+_stream_slots = BoundedSemaphore(MAX_STREAM_CLIENTS)
+_frame_state = {"id": 0, "jpeg": None, "part": None, "size": None, "viewers": 0}
+_producer_thread = None
+
+# Static multipart headers; only Content-Length varies per frame (filled via bytes %-formatting)
+_PART_HEADER = (
+    b"--frame\r\n"
+    b"Content-Type: image/jpeg\r\n"
+    b"Cache-Control: no-cache, no-store, must-revalidate\r\n"
+    b"Pragma: no-cache\r\n"
+    b"Expires: 0\r\n"
+    b"Content-Length: %d\r\n\r\n"
+)
+
+def _multipart_part(frame):
+    """Wrap one JPEG as a multipart part; built once per frame and shared by every client."""
+    return b"".join((_PART_HEADER % len(frame), frame, b"\r\n"))
+
+def _fit_stream_width(img):
+    """Downscale a stream frame (still BGRA) to at most STREAM_MAX_WIDTH wide, keeping aspect ratio."""
+    h, w = img.shape[:2]
+    if STREAM_MAX_WIDTH <= 0 or w <= STREAM_MAX_WIDTH:
+        return img
+    return cv2.resize(img, (STREAM_MAX_WIDTH, max(1, round(h * STREAM_MAX_WIDTH / w))),
+                      interpolation=cv2.INTER_AREA)
+
+def _frame_digest(img):
+    """Cheap content hash of a contiguous frame buffer (xxh3 when installed, else crc32)."""
+    if xxh3_64_intdigest is not None:
+        return xxh3_64_intdigest(img)
+    return zlib.crc32(img)
+
+def _pin_current_thread(cpus):
+    """Restrict the calling thread to the given CPU indices."""
+    if sys.platform == "win32":
+        kernel32 = ctypes.windll.kernel32
+        kernel32.GetCurrentThread.restype = ctypes.c_void_p
+        kernel32.SetThreadAffinityMask.argtypes = (ctypes.c_void_p, ctypes.c_size_t)
+        kernel32.SetThreadAffinityMask.restype = ctypes.c_size_t
+        if not kernel32.SetThreadAffinityMask(kernel32.GetCurrentThread(), sum(1 << c for c in cpus)):
+            raise ctypes.WinError()
+    elif hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)   # Linux: pid 0 is the calling thread
+    else:
+        raise OSError("thread CPU affinity not supported on this platform")
+
+def _producer_loop():
+    if PRODUCER_CPUS:
+        try:
+            _pin_current_thread(PRODUCER_CPUS)
+            app.logger.info("Frame producer pinned to CPUs %s", list(PRODUCER_CPUS))
+        except Exception as e:
+            app.logger.warning("Could not pin frame producer to CPUs %s: %s", list(PRODUCER_CPUS), e)
+    try:
+        _produce_frames()
+    except Exception:
+        # Waiters notice the dead thread via _next_frame's timeout and end their responses
+        app.logger.exception("Frame producer stopped")
+    finally:
+        with _frame_cond:
+            _frame_cond.notify_all()
+
+def _produce_frames():
     frame_interval = 1.0 / max(FPS, 1)
-    with mss.mss() as sct:
+    deadline = time.perf_counter()
+    last_digest, last_publish = None, 0.0
+    with _open_grabber() as sct:
         while True:
-            t0 = time.time()
+            with _frame_cond:
+                # Idle (no grabs/encodes) while nobody is watching
+                _frame_cond.wait_for(lambda: _frame_state["viewers"] > 0)
+
+            deadline += frame_interval
             img, err = grab_frame(sct)
             if err:
                 app.logger.warning("Frame error: %s", err)
+
             try:
-                frame = encode_jpeg(img)
+                # Same pixels as the last encoded frame: skip the encode, and only re-send
+                # the previous JPEG every MAX_IDLE_SEC so clients see the stream is alive
+                digest = _frame_digest(img)
+                if digest == last_digest:
+                    if deadline - last_publish < MAX_IDLE_SEC:
+                        frame = None
+                    else:
+                        frame, part, size = _frame_state["jpeg"], _frame_state["part"], _frame_state["size"]
+                else:
+                    img = _fit_stream_width(img)
+                    frame = encode_jpeg(img)
+                    part = _multipart_part(frame)
+                    size = (img.shape[1], img.shape[0])
+                    last_digest = digest
             except Exception as e:
                 app.logger.error("JPEG encode error: %s", e)
                 time.sleep(0.2)
                 continue
 
-            with lock:
-                yield (
-                    b"--frame\r\n"
-                    b"Content-Type: image/jpeg\r\n"
-                    b"Cache-Control: no-cache, no-store, must-revalidate\r\n"
-                    b"Pragma: no-cache\r\n"
-                    b"Expires: 0\r\n"
-                    b"Content-Length: " + str(len(frame)).encode() + b"\r\n\r\n" + frame + b"\r\n"
-                )
+            if frame is not None:
+                with _frame_cond:
+                    _frame_state["id"] += 1
+                    _frame_state["jpeg"] = frame
+                    _frame_state["part"] = part
+                    _frame_state["size"] = size
+                    _frame_cond.notify_all()
+                last_publish = deadline
+
+            # Monotonic deadline pacing: no drift, no NTP jumps, one clock read per frame
+            sleep_for = deadline - time.perf_counter()
+            if sleep_for > 0:
+                time.sleep(sleep_for)
+            else:
+                deadline = time.perf_counter()   # fell behind (or was idle): restart the cadence
+
+def _ensure_producer():
+    """Start the producer thread on first use (or restart it if it died)."""
+    global _producer_thread
+    with lock:
+        if _producer_thread is None or not _producer_thread.is_alive():
+            _producer_thread = Thread(target=_producer_loop, name="frame-producer", daemon=True)
+            _producer_thread.start()
+
+def _add_viewer():
+    _ensure_producer()
+    with _frame_cond:
+        _frame_state["viewers"] += 1
+        _frame_cond.notify_all()
+
+def _remove_viewer():
+    with _frame_cond:
+        _frame_state["viewers"] -= 1
+
+def _producer_alive():
+    thread = _producer_thread
+    return thread is not None and thread.is_alive()
+
+def _next_frame(last_id):
+    """Block until a frame newer than last_id is published; return (id, jpeg, part), or None if the producer died."""
+    with _frame_cond:
+        while not _frame_cond.wait_for(lambda: _frame_state["id"] != last_id, timeout=1.0):
+            if not _producer_alive():
+                return None
+        return _frame_state["id"], _frame_state["jpeg"], _frame_state["part"]
 
-            dt = time.time() - t0
-            if dt < frame_interval:
-                time.sleep(frame_interval - dt)
+def mjpeg_generator():
+    last_id = 0
+    _add_viewer()
+    try:
+        while True:
+            latest = _next_frame(last_id)
+            if latest is None:
+                app.logger.warning("Frame producer is not running; ending stream")
+                return
+            frame_id, _, part = latest
+            if last_id and frame_id - last_id > 1:
+                app.logger.debug("Stream client skipped %d frame(s)", frame_id - last_id - 1)
+            last_id = frame_id
+            yield part
+    finally:
+        _remove_viewer()
+
+def fmp4_generator(ffmpeg):
+    """Pipe the shared producer's JPEGs through ffmpeg/libx264 and yield fragmented MP4 bytes."""
+    _add_viewer()
+    try:
+        latest = _next_frame(0)
+        if latest is None:
+            return
+        _, first_jpeg, _ = latest
+        # libx264 needs even dimensions and a fixed size for the whole stream: pin the
+        # output to the first frame's size (rounded up to even) and letterbox anything
+        # else (error frame, /set_roi changes, STREAM_MAX_WIDTH) into it
+        w, h = _frame_state["size"] or (640, 480)
+        w, h = w + w % 2, h + h % 2
+        vf = (f"scale={w}:{h}:force_original_aspect_ratio=decrease:force_divisible_by=2,"
+              f"pad={w}:{h}:(ow-iw)/2:(oh-ih)/2")
+        cmd = [
+            ffmpeg, "-loglevel", "error",
+            "-f", "mjpeg", "-framerate", str(FPS), "-i", "pipe:0",
+            "-an", "-vf", vf, "-c:v", "libx264", "-preset", "veryfast", "-tune", "zerolatency",
+            "-pix_fmt", "yuv420p", "-g", str(2 * max(FPS, 1)),
+            "-f", "mp4", "-movflags", "frag_keyframe+empty_moov+default_base_moof", "pipe:1",
+        ]
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def feed(jpeg):
+            # ffmpeg stamps input JPEGs 1/FPS apart, but the producer skips unchanged
+            # frames: write exactly one JPEG per tick, repeating the latest, to keep real time
+            frame_interval = 1.0 / max(FPS, 1)
+            deadline = time.perf_counter()
+            try:
+                while proc.poll() is None and _producer_alive():
+                    proc.stdin.write(jpeg)
+                    proc.stdin.flush()
+                    deadline += frame_interval
+                    sleep_for = deadline - time.perf_counter()
+                    if sleep_for > 0:
+                        time.sleep(sleep_for)
+                    else:
+                        deadline = time.perf_counter()
+                    with _frame_cond:
+                        jpeg = _frame_state["jpeg"]
+                proc.stdin.close()   # producer gone: let ffmpeg flush and exit, ending the response
+            except (OSError, ValueError):   # ffmpeg exited / pipe closed
+                pass
+
+        Thread(target=feed, args=(first_jpeg,), name="fmp4-feed", daemon=True).start()
+        try:
+            while True:
+                chunk = proc.stdout.read1(64 * 1024)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            proc.kill()
+            proc.wait()
+    finally:
+        _remove_viewer()
+
+def _prepend(first, gen):
+    """Yield first, then the rest of gen; closing this closes gen."""
+    try:
+        yield first
+        yield from gen
+    finally:
+        gen.close()
 
 
 # ---------------- Views ----------------
 
 # Full-screen viewer (fills screen; no black bars via object-fit:cover)
-@app.route("/")
-def index():
-    return render_template_string("""
+_INDEX_HTML = """
     <!doctype html><title>DMV-Viewer (Cover)</title>
     <style>html,body{margin:0;height:100%}
     img{width:100vw;height:100vh;object-fit:cover;display:block;background:#000}</style>
     <img src="/stream.mjpg" alt="DMV-Viewer stream">
-    """)
+    """.encode()
+
+@app.route("/")
+def index():
+    return Response(_INDEX_HTML, mimetype="text/html")
 
 @app.route("/stream.mjpg")
 def stream():
+    if not _stream_slots.acquire(blocking=False):
+        return {"ok": False, "message": "Too many stream clients"}, 503
     resp = Response(mjpeg_generator(), mimetype="multipart/x-mixed-replace; boundary=frame")
+    resp.call_on_close(_stream_slots.release)
     resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     resp.headers["Pragma"] = "no-cache"
     resp.headers["Expires"] = "0"
     return resp
 
+# H.264 fragmented-MP4 stream (much smaller than MJPEG on mostly-static UI); needs ffmpeg
+@app.route("/stream.m4s")
+def stream_m4s():
+    ffmpeg = shutil.which(FFMPEG_BIN)
+    if not ffmpeg:
+        return {"ok": False, "message": f"'{FFMPEG_BIN}' not found on PATH"}, 503
+    if not _stream_slots.acquire(blocking=False):
+        return {"ok": False, "message": "Too many stream clients"}, 503
+    # Start ffmpeg before answering so a failed encoder is a 502, not an empty 200
+    gen = fmp4_generator(ffmpeg)
+    try:
+        first = next(gen, None)
+    except Exception as e:
+        app.logger.error("ffmpeg start failed: %s", e)
+        first = None
+    if first is None:
+        _stream_slots.release()
+        return {"ok": False, "message": "ffmpeg produced no output"}, 502
+    resp = Response(_prepend(first, gen), mimetype="video/mp4")
+    resp.call_on_close(_stream_slots.release)
+    resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    resp.headers["Pragma"] = "no-cache"
+    resp.headers["Expires"] = "0"
+    return resp
+
+# <video> player for /stream.m4s (progressive fMP4 playback)
+_VIEW_VIDEO_HTML = """
+    <!doctype html><title>DMV-Viewer (fMP4)</title>
+    <style>html,body{margin:0;height:100%;background:#000}
+    video{width:100vw;height:100vh;object-fit:cover;display:block}</style>
+    <video src="/stream.m4s" autoplay muted playsinline></video>
+    """.encode()
+
+@app.route("/view_video")
+def view_video():
+    return Response(_VIEW_VIDEO_HTML, mimetype="text/html")
+
 # Single snapshot of the current cropped frame
 @app.route("/snapshot.jpg")
 def snapshot():
-    with mss.mss() as sct:
+    with _MssGrabber() as sct:
         img, _ = grab_frame(sct)
         jpg = encode_jpeg(img)
     r = make_response(jpg)
@@ -185,7 +695,7 @@ def snapshot():
 # Full window snapshot (for measuring & debugging)
 @app.route("/full_window.jpg")
 def full_window_jpg():
-    with mss.mss() as sct:
+    with _MssGrabber() as sct:
         img, _ = grab_full_window(sct)
         jpg = encode_jpeg(img)
     r = make_response(jpg)
@@ -193,24 +703,40 @@ def full_window_jpg():
     r.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     return r
 
+# Grid for /snapshot_grid.jpg, rendered once per window size instead of per request
+_grid_overlay_cache = {}   # (w, h) -> HxWx3 white-on-black grid + labels (full-window sized; keep few)
+
+def _grid_overlay(w, h):
+    overlay = _grid_overlay_cache.get((w, h))
+    if overlay is None:
+        if len(_grid_overlay_cache) >= 2:
+            _grid_overlay_cache.clear()
+        overlay = np.zeros((h, w, 3), dtype=np.uint8)
+        step = max(50, min(200, w // 12))
+        # Axis-aligned 1px lines: strided slice writes instead of one cv2.line call per line
+        overlay[:, ::step] = 255
+        overlay[::step, :] = 255
+        for x in range(0, w, step):
+            cv2.putText(overlay, str(x), (x + 3, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+        for y in range(0, h, step):
+            cv2.putText(overlay, str(y), (3, y + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+        _grid_overlay_cache[(w, h)] = overlay
+    return overlay
+
 # Grid helper drawn over the full window + current ROI outline (green)
 @app.route("/snapshot_grid.jpg")
 def snapshot_grid():
     try:
-        with mss.mss() as sct:
+        with _MssGrabber() as sct:
             base, bbox_win = grab_full_window(sct)
     except Exception:
-        with mss.mss() as sct:
+        with _MssGrabber() as sct:
             base, _ = grab_frame(sct)
+    base = _to_bgr(base)
 
     h, w = base.shape[:2]
-    step = max(50, min(200, w // 12))
-    for x in range(0, w, step):
-        cv2.line(base, (x, 0), (x, h), (255, 255, 255), 1)
-        cv2.putText(base, str(x), (x + 3, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
-    for y in range(0, h, step):
-        cv2.line(base, (0, y), (w, y), (255, 255, 255), 1)
-        cv2.putText(base, str(y), (3, y + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1)
+    # White-on-black grid: OR-ing it in is identical to drawing it on 'base'
+    cv2.bitwise_or(base, _grid_overlay(w, h), dst=base)
 
     try:
         bbox_win = find_window_bbox()
@@ -234,33 +760,35 @@ def snapshot_grid():
     return r
 
 # JS-free fallback snapshot "video" (works in old IE/WebView engines)
-@app.route("/view_meta")
-def view_meta():
-    refresh_sec = 0.2
-    ts = int(time.time() * 1000)
-    return render_template_string(f"""
+_VIEW_META_REFRESH_SEC = 0.2
+_VIEW_META_HTML = f"""
     <!doctype html><title>DMV-Viewer (Meta Refresh)</title>
-    <meta http-equiv="refresh" content="{refresh_sec}; url=/view_meta">
+    <meta http-equiv="refresh" content="{_VIEW_META_REFRESH_SEC}; url=/view_meta">
     <style>html,body{{height:100%;margin:0;background:#111;display:grid;place-items:center}}
     img{{max-width:100vw;max-height:100vh}}
     .note{{position:fixed;top:10px;left:10px;color:#aaa;font:14px/1.4 system-ui,sans-serif}}</style>
-    <div class="note">Fallback: meta-refresh ~{1/refresh_sec:.1f} fps</div>
-    <img src="/snapshot.jpg?ts={ts}" alt="DMV snapshot">
-    """)
+    <div class="note">Fallback: meta-refresh ~{1/_VIEW_META_REFRESH_SEC:.1f} fps</div>
+    <img src="/snapshot.jpg?ts={{TS}}" alt="DMV snapshot">
+    """.encode()
+
+@app.route("/view_meta")
+def view_meta():
+    ts = int(time.time() * 1000)
+    return Response(_VIEW_META_HTML.replace(b"{TS}", str(ts).encode()), mimetype="text/html")
 
 # Some legacy containers prefer <object> for MJPEG
-@app.route("/view_object")
-def view_object():
-    return render_template_string("""
+_VIEW_OBJECT_HTML = """
     <!doctype html><title>DMV-Viewer (Object MJPEG)</title>
     <style>html,body{height:100%;margin:0;background:#111} object{width:100%;height:100%}</style>
     <object data="/stream.mjpg" type="image/jpeg"></object>
-    """)
+    """.encode()
+
+@app.route("/view_object")
+def view_object():
+    return Response(_VIEW_OBJECT_HTML, mimetype="text/html")
 
 # Interactive calibrator (click 2 corners; see/copy ABS/REL; apply live)
-@app.route("/measure")
-def measure():
-    return render_template_string("""
+_MEASURE_HTML = """
     <!doctype html>
     <title>ROI Calibrator</title>
     <style>
@@ -400,12 +928,16 @@ or
       probe.src = img.src;
     });
     </script>
-    """)
+    """.encode()
+
+@app.route("/measure")
+def measure():
+    return Response(_MEASURE_HTML, mimetype="text/html")
 
 # Apply ROI at runtime (no restart)
 @app.route("/set_roi")
 def set_roi():
-    global ROI_RUNTIME_MODE, ROI_RUNTIME_ABS, ROI_RUNTIME_REL
+    global ROI_RUNTIME_MODE, ROI_RUNTIME_ABS, ROI_RUNTIME_REL, ROI_VERSION
     mode = (request.args.get("mode") or "").lower()
     if mode == "absolute":
         x = int(float(request.args.get("x", 0)))
@@ -415,6 +947,7 @@ def set_roi():
         ROI_RUNTIME_MODE = "absolute"
         ROI_RUNTIME_ABS  = (x, y, w, h)
         ROI_RUNTIME_REL  = None
+        ROI_VERSION += 1
         return {"ok": True, "message": f"Applied ABS_ROI=({x},{y},{w},{h})"}
     elif mode == "relative":
         l = float(request.args.get("l", 0))
@@ -424,6 +957,7 @@ def set_roi():
         ROI_RUNTIME_MODE = "relative"
         ROI_RUNTIME_REL  = (l, t, r, b)
         ROI_RUNTIME_ABS  = None
+        ROI_VERSION += 1
         return {"ok": True, "message": f"Applied REL_ROI=({l:.6f},{t:.6f},{r:.6f},{b:.6f})"}
     else:
         return {"ok": False, "message": "Specify mode=absolute or mode=relative"}, 400
@@ -450,4 +984,9 @@ def health():
 # ---------------- App start ----------------
 
 if __name__ == "__main__":
-    app.run(host=BIND_IP, port=PORT, threaded=True)
+    try:
+        from waitress import serve
+    except ImportError:     # Flask dev server fallback
+        app.run(host=BIND_IP, port=PORT, threaded=True)
+    else:
+        serve(app, host=BIND_IP, port=PORT, threads=SERVER_THREADS)